@@ -1,101 +1,229 @@
+import aiohttp
+from aiohttp import web
+import asyncio
+import fcntl
 import requests
-import json
+from requests.adapters import HTTPAdapter
+import hashlib
+import heapq
+import orjson
+import queue
+import threading
 import time
-import schedule
+from collections import Counter
+from itertools import chain
 from datetime import datetime
 import os
-from typing import Set, Dict, List
+import sys
+from typing import Set, Dict, List, Optional, FrozenSet
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
 
+def format_timestamp(now: datetime) -> str:
+    """Format a datetime as 'YYYY-MM-DD HH:MM:SS' without strftime's
+    format-specifier walk."""
+    return (f"{now.year:04d}-{now.month:02d}-{now.day:02d} "
+            f"{now.hour:02d}:{now.minute:02d}:{now.second:02d}")
+
+# Bound at module level so the hot logging path skips the attribute
+# lookups and the datetime object construction
+_strftime = time.strftime
+_localtime = time.localtime
+
 def log_message(message: str):
     """Prints a message with a timestamp."""
-    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    print(f"[{timestamp}] {message}")
+    print(f"[{_strftime('%Y-%m-%d %H:%M:%S', _localtime())}] {message}")
 
 class PNodeMonitor:
     def __init__(self, webhook_url: str, check_interval_hours: int):
         self.api_url = "http://atlas.devnet.xandeum.com:3000/api/pods"
         self.webhook_url = webhook_url
         self.check_interval_hours = check_interval_hours
-        self.previous_nodes: Set[str] = set()
+
+        # Adaptive polling: check sooner while the network is churning,
+        # back off while it is stable. The configured interval is the seed.
+        self.next_interval = check_interval_hours * 3600
+        self.min_interval = 5 * 60
+        self.max_interval = max(4 * 3600, self.next_interval)
+        # Immutable so its hash is computed once and cached, and so no
+        # code path can mutate the baseline between checks
+        self.previous_nodes: FrozenSet[str] = frozenset()
         self.first_run = True
-        
+
+        # Reuse one session so retries and webhook posts share keep-alive
+        # connections instead of paying a TCP+TLS handshake per request
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'User-Agent': 'pnode-monitor'})
+
+        # Pre-warm a pooled TLS connection to the webhook host so the
+        # first real post skips the TCP and TLS handshakes
+        try:
+            self.session.head(self.webhook_url, timeout=5)
+        except requests.exceptions.RequestException:
+            pass
+        self._payload_headers = {'Content-Type': 'application/json; charset=UTF-8'}
+
+        # Hash of the last webhook body (minus its timestamp line), used to
+        # drop byte-identical posts for up to a day
+        self._last_msg_hash: Optional[bytes] = None
+        self._last_send = 0.0
+
+        # Webhook posts drain on a daemon thread so a slow Google Chat
+        # response can't hold up the check loop
+        self._webhook_q: queue.Queue = queue.Queue(maxsize=32)
+        self._webhook_thread = threading.Thread(target=self._webhook_worker, daemon=True)
+        self._webhook_thread.start()
+
+        # Shared aiohttp session for API fetches, created lazily on the
+        # event loop so its keep-alive connections survive across checks
+        self._http_session: Optional[aiohttp.ClientSession] = None
+
+        # Last ETag seen from the API, with the node set decoded from that
+        # same response; sent back as If-None-Match so an unchanged pod
+        # list costs a 304 instead of a full body. A 304 must resolve to
+        # _etag_nodes, never previous_nodes — the ETag can belong to a
+        # body the monitor has not adopted as its baseline yet.
+        self._etag: Optional[str] = None
+        self._etag_nodes: Optional[Set[str]] = None
+
+        # The last quorum result; a single probe equal to it is trusted
+        # without the extra verification calls. Kept as the set itself
+        # rather than a hash so a collision can't bypass verification.
+        self._last_probe_result: Optional[FrozenSet[str]] = None
+
         # Load previous state if exists
         self.state_file = "pnode_state.json"
+
+        # Hold an exclusive lock for the life of the process so a second
+        # instance can't interleave state reads and writes with this one
+        self._lock_fd = os.open(f"{self.state_file}.lock", os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            log_message(f"Error: another monitor already holds {self.state_file}.lock")
+            raise SystemExit(1)
+
         self.load_state()
 
     def load_state(self):
         """Load the previous state from file if it exists."""
         try:
-            if os.path.exists(self.state_file):
-                with open(self.state_file, 'r') as f:
-                    data = json.load(f)
-                    loaded_nodes = set(data.get('nodes', []))
-                    # Sanity check: only accept state if it's not empty
-                    if loaded_nodes:
-                        log_message(f"Loaded previous state with {len(loaded_nodes)} nodes")
-                        self.previous_nodes = loaded_nodes
-                        self.first_run = False
-                    else:
-                        log_message("Previous state was empty, treating as first run")
+            # Open directly and catch the miss (EAFP), then slurp the file
+            # in one read sized from fstat, skipping the buffered
+            # file-object layer
+            fd = os.open(self.state_file, os.O_RDONLY)
+            try:
+                buf = os.read(fd, os.fstat(fd).st_size)
+            finally:
+                os.close(fd)
+            data = orjson.loads(buf)
+            # Intern the IDs so they share storage with the sets
+            # fetched from the API
+            loaded_nodes = {sys.intern(node) for node in data.get('nodes', [])}
+            # Sanity check: only accept state if it's not empty
+            if loaded_nodes:
+                log_message(f"Loaded previous state with {len(loaded_nodes)} nodes")
+                self.previous_nodes = frozenset(loaded_nodes)
+                self.first_run = False
             else:
-                log_message("No previous state found, treating as first run")
+                log_message("Previous state was empty, treating as first run")
+        except FileNotFoundError:
+            log_message("No previous state found, treating as first run")
         except Exception as e:
             log_message(f"Error loading state: {e}")
 
     def save_state(self, nodes: Set[str]):
-        """Save the current state to file."""
+        """Save the current state to file atomically."""
         try:
             # Only save state if we have nodes
             if nodes:
-                # Create a backup of the current state file if it exists
-                if os.path.exists(self.state_file):
-                    backup_file = f"{self.state_file}.backup"
-                    try:
-                        with open(self.state_file, 'r') as src, open(backup_file, 'w') as dst:
-                            dst.write(src.read())
-                    except Exception as e:
-                        log_message(f"Error creating backup: {e}")
-
-                with open(self.state_file, 'w') as f:
-                    json.dump({'nodes': list(nodes)}, f)
+                # Write to a temp file and rename it over the original so a
+                # crash mid-write can never leave a torn state file. This
+                # replaces the old backup-copy step, which rewrote the whole
+                # file twice per save.
+                tmp_file = f"{self.state_file}.tmp"
+                # orjson returns bytes, so write them unbuffered in one
+                # syscall; sorting keeps the file diffable across saves
+                with open(tmp_file, 'wb', buffering=0) as f:
+                    f.write(orjson.dumps({'nodes': sorted(nodes)}))
+                    # Make sure the bytes are on disk before the rename
+                    # publishes them
+                    os.fsync(f.fileno())
+                os.replace(tmp_file, self.state_file)
                 log_message(f"Saved state with {len(nodes)} nodes")
             else:
                 log_message("No nodes to save, skipping state save")
         except Exception as e:
             log_message(f"Error saving state: {e}")
 
-    def get_nodes_with_retry(self, retries: int = 3, delay: int = 5) -> Set[str]:
-        """Fetch current nodes from the API with retries and verification."""
-        all_results = []
-        
-        # Make multiple API calls
-        for attempt in range(retries):
-            try:
-                response = requests.get(self.api_url, timeout=10)
+    async def _fetch_once(self, session: aiohttp.ClientSession, attempt: int) -> Optional[Set[str]]:
+        """Make a single API call and return the node set, or None on failure."""
+        headers = {'If-None-Match': self._etag} if self._etag else None
+        try:
+            async with session.get(self.api_url, headers=headers) as response:
+                if response.status == 304:
+                    # Body unchanged relative to the ETag we sent; reuse the
+                    # set decoded from that response without downloading or
+                    # parsing a body
+                    log_message(f"API call {attempt}: Not modified")
+                    return self._etag_nodes
                 response.raise_for_status()
+                # Decode with orjson from the raw bytes to bypass stdlib json
                 # Handle cases where 'pods' key might be missing
-                nodes = set(response.json().get('pods', []))
-                all_results.append(nodes)
-                log_message(f"API call {attempt + 1}: Found {len(nodes)} nodes")
-                
-                if attempt < retries - 1:  # Don't sleep on the last attempt
-                    time.sleep(delay)
-                    
-            except requests.exceptions.RequestException as e:
-                log_message(f"Error in API call {attempt + 1}: {e}")
-                if attempt < retries - 1:
-                    time.sleep(delay)
-                continue
-            except json.JSONDecodeError as e:
-                log_message(f"Error decoding JSON in API call {attempt + 1}: {e}")
-                if attempt < retries - 1:
-                    time.sleep(delay)
-                continue
+                # Node IDs are short ASCII strings that recur every check, so
+                # intern them to share one str object across all live sets
+                nodes = {sys.intern(pod) for pod in orjson.loads(await response.read()).get('pods', [])}
+                self._etag = response.headers.get('ETag')
+                self._etag_nodes = nodes
+                log_message(f"API call {attempt}: Found {len(nodes)} nodes")
+                return nodes
+        except aiohttp.ClientError as e:
+            log_message(f"Error in API call {attempt}: {e}")
+        except orjson.JSONDecodeError as e:
+            log_message(f"Error decoding JSON in API call {attempt}: {e}")
+        except asyncio.TimeoutError:
+            log_message(f"Timeout in API call {attempt}")
+        return None
+
+    def _http(self) -> aiohttp.ClientSession:
+        """Return the shared aiohttp session, creating it on first use."""
+        if self._http_session is None or self._http_session.closed:
+            connector = aiohttp.TCPConnector(limit=8, keepalive_timeout=300)
+            timeout = aiohttp.ClientTimeout(total=10)
+            self._http_session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._http_session
+
+    async def get_nodes_with_retry(self, retries: int = 3) -> Set[str]:
+        """Fetch current nodes from the API, verifying across probes.
+
+        A single probe that matches the last stable result is accepted
+        as-is; otherwise the remaining probes run concurrently and the
+        majority quorum decides.
+        """
+        session = self._http()
+        first = await self._fetch_once(session, 1)
+        if first is not None and first == self._last_probe_result:
+            return first
+
+        remaining = []
+        if retries > 1:
+            remaining = await asyncio.gather(
+                *[self._fetch_once(session, attempt + 2) for attempt in range(retries - 1)]
+            )
+        all_results = [nodes for nodes in [first, *remaining] if nodes is not None]
+
+        consistent_nodes = self._resolve_quorum(all_results)
+        if consistent_nodes:
+            self._last_probe_result = frozenset(consistent_nodes)
+        return consistent_nodes
 
+    def _resolve_quorum(self, all_results: List[Set[str]]) -> Set[str]:
+        """Reduce the probe results to the majority-agreed node set."""
         if not all_results:
             log_message("All API calls failed to return data.")
             return set()
@@ -108,17 +236,26 @@ class PNodeMonitor:
         # Find nodes that appear in the majority of results
         if len(all_results) == 1:
             return all_results[0]
-        
-        node_sets = list(all_results)
-        
-        consistent_nodes = set()
-        all_seen_nodes = set().union(*node_sets)
-        
-        for node in all_seen_nodes:
-            appearances = sum(1 for node_set in node_sets if node in node_set)
-            if appearances >= len(node_sets) // 2 + 1:
-                consistent_nodes.add(node)
-        
+
+        # Common case: every probe returned the same set, so the quorum
+        # is trivially that set
+        if all(result == all_results[0] for result in all_results[1:]):
+            return all_results[0]
+
+        # With exactly 3 samples the majority reduces to three C-level
+        # set operations
+        if len(all_results) == 3:
+            a, b, c = all_results
+            consistent_nodes = (a & b) | (b & c) | (a & c)
+            log_message(f"Found {len(consistent_nodes)} consistent nodes across 3 API calls")
+            return consistent_nodes
+
+        # Count appearances in one C-level pass instead of re-scanning
+        # every result set per node
+        threshold = len(all_results) // 2 + 1
+        counts = Counter(chain.from_iterable(all_results))
+        consistent_nodes = {node for node, count in counts.items() if count >= threshold}
+
         log_message(f"Found {len(consistent_nodes)} consistent nodes across {len(all_results)} API calls")
         return consistent_nodes
 
@@ -170,6 +307,17 @@ class PNodeMonitor:
                 'is_first_run': True
             }
 
+        # Equality is a single short-circuiting C-level scan; skip building
+        # both difference sets when nothing changed
+        if current_nodes == self.previous_nodes:
+            return {
+                'total_nodes': len(current_nodes),
+                'new_nodes': [],
+                'offline_nodes': [],
+                'is_first_run': False,
+                'skipped_update': False
+            }
+
         new_nodes = current_nodes - self.previous_nodes
         offline_nodes = self.previous_nodes - current_nodes
 
@@ -193,73 +341,167 @@ class PNodeMonitor:
 
     def format_message(self, stats: Dict) -> str:
         """Format the statistics into a readable message."""
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        timestamp = format_timestamp(datetime.now())
         
         if stats.get('api_error_drop_to_zero'):
-            message = f"🚨 *CRITICAL ALERT: pNode API Failure* - {timestamp}\n\n"
-            message += "• The API is reporting ZERO active nodes.\n"
-            message += f"• Previously, there were {stats['previous_total_nodes']} nodes.\n"
-            message += "• This could indicate a major network outage or API failure.\n"
-            message += "• *Action required: Please investigate immediately.*\n"
-            return message
+            return (
+                f"🚨 *CRITICAL ALERT: pNode API Failure* - {timestamp}\n\n"
+                "• The API is reporting ZERO active nodes.\n"
+                f"• Previously, there were {stats['previous_total_nodes']} nodes.\n"
+                "• This could indicate a major network outage or API failure.\n"
+                "• *Action required: Please investigate immediately.*\n"
+            )
 
         if stats['is_first_run']:
-            message = f"🚀 *Initial pNode Network Status* - {timestamp}\n\n"
-            message += f"• Total Active Nodes: {stats['total_nodes']}\n"
-            return message
+            return (
+                f"🚀 *Initial pNode Network Status* - {timestamp}\n\n"
+                f"• Total Active Nodes: {stats['total_nodes']}\n"
+            )
 
         if stats.get('skipped_update', False):
-            message = f"⚠️ *pNode Network Status Update (Skipped)* - {timestamp}\n\n"
-            message += "• Update skipped due to suspicious changes (e.g., >50% change).\n"
-            message += f"• Maintaining previous count: {stats['total_nodes']} nodes\n"
-            return message
+            return (
+                f"⚠️ *pNode Network Status Update (Skipped)* - {timestamp}\n\n"
+                "• Update skipped due to suspicious changes (e.g., >50% change).\n"
+                f"• Maintaining previous count: {stats['total_nodes']} nodes\n"
+            )
+
+        # Collect fragments and join once at the end instead of growing a
+        # str with +=, which copies the whole message on every append
+        parts = [
+            f"📊 *pNode Network Status Update* - {timestamp}\n\n",
+            f"• Total Active Nodes: {stats['total_nodes']}\n",
+        ]
 
-        message = f"📊 *pNode Network Status Update* - {timestamp}\n\n"
-        message += f"• Total Active Nodes: {stats['total_nodes']}\n"
-        
         if stats['new_nodes']:
-            message += f"\n🆕 *New Nodes ({len(stats['new_nodes'])})* 🆕\n"
-            for node in sorted(stats['new_nodes'])[:5]:
-                message += f"• {node}\n"
+            parts.append(f"\n🆕 *New Nodes ({len(stats['new_nodes'])})* 🆕\n")
+            # nsmallest gives the first 5 in sorted order without sorting
+            # the whole list
+            parts.extend(f"• {node}\n" for node in heapq.nsmallest(5, stats['new_nodes']))
             if len(stats['new_nodes']) > 5:
-                message += f"• ... and {len(stats['new_nodes']) - 5} more\n"
+                parts.append(f"• ... and {len(stats['new_nodes']) - 5} more\n")
 
         if stats['offline_nodes']:
-            message += f"\n⚠️ *Offline Nodes ({len(stats['offline_nodes'])})* ⚠️\n"
-            for node in sorted(stats['offline_nodes'])[:5]:
-                message += f"• {node}\n"
+            parts.append(f"\n⚠️ *Offline Nodes ({len(stats['offline_nodes'])})* ⚠️\n")
+            parts.extend(f"• {node}\n" for node in heapq.nsmallest(5, stats['offline_nodes']))
             if len(stats['offline_nodes']) > 5:
-                message += f"• ... and {len(stats['offline_nodes']) - 5} more\n"
+                parts.append(f"• ... and {len(stats['offline_nodes']) - 5} more\n")
 
-        return message
+        return ''.join(parts)
 
     def send_to_webhook(self, message: str):
-        """Send the formatted message to Google Chat webhook."""
+        """Queue a message for the background webhook sender."""
+        # Compare everything below the timestamped headline so a quiet
+        # network doesn't repost the same status every interval, while
+        # still letting one post a day through as a heartbeat
+        body = message.split('\n', 1)[-1]
+        msg_hash = hashlib.blake2b(body.encode(), digest_size=16).digest()
+        if msg_hash == self._last_msg_hash and time.time() - self._last_send < 86400:
+            log_message("Webhook post skipped, content unchanged since last send")
+            return
         try:
-            payload = {'text': message}
-            response = requests.post(self.webhook_url, json=payload, timeout=10)
-            response.raise_for_status()
-            log_message("Message sent successfully")
-        except requests.exceptions.RequestException as e:
-            log_message(f"Error sending message: {e}")
-
-    def run_check(self):
+            self._webhook_q.put_nowait((message, msg_hash))
+        except queue.Full:
+            log_message("Webhook queue full, dropping message")
+
+    def _webhook_worker(self):
+        """Drain queued messages so checks aren't blocked by webhook latency."""
+        while True:
+            item = self._webhook_q.get()
+            if item is None:
+                break
+            message, msg_hash = item
+            try:
+                # Serialize with orjson and send the bytes directly rather
+                # than going through requests' stdlib json encoding
+                payload = orjson.dumps({'text': message})
+                response = self.session.post(
+                    self.webhook_url, data=payload, headers=self._payload_headers, timeout=10
+                )
+                response.raise_for_status()
+                self._last_msg_hash = msg_hash
+                self._last_send = time.time()
+                log_message("Message sent successfully")
+            except requests.exceptions.RequestException as e:
+                log_message(f"Error sending message: {e}")
+            finally:
+                self._webhook_q.task_done()
+
+    def _adjust_interval(self, changed: bool):
+        """Halve the polling interval on change, double it while stable."""
+        if changed:
+            interval = max(self.min_interval, self.next_interval // 2)
+        else:
+            interval = min(self.max_interval, self.next_interval * 2)
+        if interval != self.next_interval:
+            self.next_interval = interval
+            log_message(f"Check interval adjusted to {interval // 60} minutes")
+
+    async def close(self):
+        """Flush pending webhook posts and release the HTTP connections."""
+        self._webhook_q.put(None)
+        self._webhook_thread.join(timeout=15)
+        if self._http_session is not None and not self._http_session.closed:
+            await self._http_session.close()
+        self.session.close()
+        fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+        os.close(self._lock_fd)
+
+    async def run_check(self):
         """Run a single check of the network status."""
-        current_nodes = self.get_nodes_with_retry()
-        
+        current_nodes = await self.get_nodes_with_retry()
+        self.process_nodes(current_nodes)
+
+    async def handle_event(self, request: web.Request) -> web.Response:
+        """Accept a pushed node snapshot and process it like a poll result."""
+        try:
+            data = orjson.loads(await request.read())
+        except orjson.JSONDecodeError:
+            return web.Response(status=400, text="invalid JSON")
+        # Reject well-formed JSON of the wrong shape instead of letting it
+        # raise out of a network-exposed handler
+        pods = data.get('pods') if isinstance(data, dict) else None
+        if not isinstance(pods, list) or not all(isinstance(pod, str) for pod in pods):
+            return web.Response(status=400, text='expected {"pods": ["<node-id>", ...]}')
+        nodes = {sys.intern(pod) for pod in pods}
+        log_message(f"Received pushed snapshot with {len(nodes)} nodes")
+        self.process_nodes(nodes)
+        return web.Response(text="ok")
+
+    def process_nodes(self, current_nodes: Set[str]):
+        """Diff a node snapshot against the previous state and report it."""
+        # Fast path: identical node set means no diff to compute, no state
+        # to rewrite, and no per-node formatting to do. Exact equality,
+        # not a hash compare, so a collision can't mask a real change.
+        if not self.first_run and current_nodes and current_nodes == self.previous_nodes:
+            timestamp = format_timestamp(datetime.now())
+            log_message("Node set unchanged since last check")
+            message = f"✅ *pNode Network Status: No Changes* - {timestamp}\n\n"
+            message += f"• Total Active Nodes: {len(current_nodes)}\n"
+            self.send_to_webhook(message)
+            self._adjust_interval(changed=False)
+            return
+
         stats = self.analyze_changes(current_nodes)
         message = self.format_message(stats)
         self.send_to_webhook(message)
-        
+
+        if not stats['is_first_run']:
+            # Anomalies (suspicious or zero-node readings) also poll sooner
+            # so recovery is noticed quickly
+            changed = bool(stats['new_nodes'] or stats['offline_nodes']
+                           or stats.get('skipped_update')
+                           or stats.get('api_error_drop_to_zero'))
+            self._adjust_interval(changed)
+
         if stats.get('api_error_drop_to_zero'):
             log_message("State not saved to ensure critical alert repeats if issue persists.")
             return
 
-        if not stats.get('skipped_update'):
-            self.previous_nodes = current_nodes
+        if not stats.get('skipped_update') and current_nodes != self.previous_nodes:
+            self.previous_nodes = frozenset(current_nodes)
             self.save_state(current_nodes)
 
-def main():
+async def main():
     webhook_url = os.getenv('GOOGLE_CHAT_WEBHOOK')
     if not webhook_url:
         log_message("Error: GOOGLE_CHAT_WEBHOOK environment variable not set")
@@ -275,16 +517,42 @@ def main():
         check_interval = 2
 
     monitor = PNodeMonitor(webhook_url, check_interval)
-    
+
     log_message(f"Starting pNode monitor with {check_interval} hour check interval")
-    
-    schedule.every(check_interval).hours.do(monitor.run_check)
-    
-    monitor.run_check()
-    
-    while True:
-        schedule.run_pending()
-        time.sleep(60)
+
+    # Optionally listen for pushed node snapshots; polling then acts as
+    # periodic reconciliation rather than the only source of updates
+    runner = None
+    event_port = os.getenv('PNODE_EVENT_PORT')
+    if event_port:
+        try:
+            event_port = int(event_port)
+        except ValueError:
+            log_message("Warning: Invalid PNODE_EVENT_PORT value, event listener disabled")
+            event_port = None
+    if event_port:
+        app = web.Application()
+        app.router.add_post('/pnode/event', monitor.handle_event)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, port=event_port).start()
+        log_message(f"Listening for pushed node events on port {event_port}")
+
+    # A single periodic task doesn't need a scheduler library: run the
+    # check, then sleep until the next one on the event loop. The
+    # interval adapts to how much the network is churning.
+    try:
+        while True:
+            start = time.monotonic()
+            await monitor.run_check()
+            # Anchor the next deadline to the monotonic clock so check
+            # duration and webhook latency don't drift the cadence, and
+            # wall-clock jumps (NTP) don't stall it
+            await asyncio.sleep(max(0.0, start + monitor.next_interval - time.monotonic()))
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+        await monitor.close()
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())